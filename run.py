@@ -1,78 +1,295 @@
 import argparse
-import subprocess
+import hashlib
+import json
 import os
 import pathlib
+import re
+import shlex
+import shutil
+import sys
+import threading
+import time
 
 
-root_dir = pathlib.Path(__file__).parent
+ROOT_DIR = str(pathlib.Path(__file__).resolve().parent)
+BIOS_TARGET = f'{ROOT_DIR}/x86_64-bios-target.json'
+UEFI_TARGET = 'x86_64-unknown-uefi'
+BIOS_BUILD_DIRS = {
+    False: f'{ROOT_DIR}/target/x86_64-bios-target/debug',
+    True: f'{ROOT_DIR}/target/x86_64-bios-target/release',
+}
+UEFI_BUILD_DIRS = {
+    False: f'{ROOT_DIR}/target/{UEFI_TARGET}/debug',
+    True: f'{ROOT_DIR}/target/{UEFI_TARGET}/release',
+}
+OVMF_ROOT = '/usr/share/edk2/ovmf'
+# Kept out of the UEFI build dir because that one is exposed to the guest as a FAT drive
+OVMF_DIR = f'{ROOT_DIR}/target/ovmf'
+OVMF_CODE = f'{OVMF_DIR}/OVMF_CODE.fd'
+OVMF_VARS = f'{OVMF_DIR}/OVMF_VARS.fd'
+CARGO_ENV = dict(os.environ)
+if shutil.which('sccache'):
+    # Keep the cache outside target/ so build-std objects survive a cargo clean
+    CARGO_ENV['RUSTC_WRAPPER'] = os.environ.get('RUSTC_WRAPPER', 'sccache')
+    CARGO_ENV['SCCACHE_DIR'] = os.environ.get('SCCACHE_DIR', f'{ROOT_DIR}/.sccache')
+BIOS_CARGO_ENV = {**CARGO_ENV, 'RUSTFLAGS': f'-C link-args={ROOT_DIR}/linker.ld'}
+WATCH_DIR = f"{os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))}/bmb"
+# Everything cargo reads outside the crates' own Cargo.toml and src/
+WATCH_INPUTS = tuple(f'{ROOT_DIR}/{name}' for name in ('Cargo.toml', 'linker.ld', 'x86_64-bios-target.json'))
+# Sources plus what the crates pull in with include_str!/include_bytes!
+WATCH_SRC_EXTENSIONS = ('.rs', '.s', '.bmp', '.wav')
+WATCH_STARTED = re.compile(r'^\[bmb started (\d+)\]$')
+WATCH_FINISHED = re.compile(r'^\[bmb finished (\d+)\]$')
+# Generous enough for a cold -Zbuild-std build
+WATCH_TIMEOUT = 15 * 60
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--bios', action='store_true', help='Build this project with a legacy BIOS bootloader')
 parser.add_argument('--debug', action='store_true', help='Run in qemu debug mode?')
 parser.add_argument('--build-only', action='store_true', help='Build project without running it')
 parser.add_argument('--release', action='store_true', help='Build the project for release')
+parser.add_argument('--watch', action='store_true', help='Reuse a background cargo watch instead of starting cargo')
+
+
+def _start(argv, env=None) -> int:
+    return os.posix_spawnp(argv[0], argv, env or os.environ)
+
+
+def _wait(pid) -> int:
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def _spawn(argv, env=None) -> int:
+    return _wait(_start(argv, env))
+
+
+def _cargo_build(argv, env, artifact) -> tuple:
+    """Runs a cargo build and reports whether `artifact` was already fresh"""
+    read_fd, write_fd = os.pipe()
+    pid = os.posix_spawnp(argv[0], (*argv, '--message-format=json-render-diagnostics'), env,
+        file_actions=[(os.POSIX_SPAWN_DUP2, write_fd, 1), (os.POSIX_SPAWN_CLOSE, read_fd)])
+    os.close(write_fd)
+    fresh = False
+    with os.fdopen(read_fd) as messages:
+        for line in messages:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if msg.get('reason') == 'compiler-artifact' and msg.get('target', {}).get('name') == artifact:
+                fresh = bool(msg.get('fresh'))
+    return _wait(pid), fresh
+
+
+def _is_watcher(pid) -> bool:
+    # The pid may have been reused since the pid file was written, and a watcher that
+    # already exited but wasn't reaped yet has an empty cmdline
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            cmdline = f.read().split(b'\0')
+        cwd = os.path.realpath(f'/proc/{pid}/cwd')
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return False
+    return cwd == ROOT_DIR and any(os.path.basename(arg) == b'cargo' and next_arg == b'watch' for arg, next_arg in zip(cmdline, cmdline[1:]))
 
 
-def build_with_bios(base_cargo_args, release=False) -> int:
-    sub_dir = 'release' if release else 'debug'
-    BUILD_DIR = f'{root_dir}/target/x86_64-bios-target/{sub_dir}'
-    cargo = [*base_cargo_args, '--features', 'bios']
-    cargo_env = dict(os.environ, RUSTFLAGS=f'-C link-args={root_dir}/linker.ld')
-    objcopy_strip_debug = ['objcopy', '--only-keep-debug', f'{BUILD_DIR}/bootloader', f'{BUILD_DIR}/bmb_sym']
-    objcopy_output_binary = ['objcopy', '-O', 'binary', f'{BUILD_DIR}/bootloader', f'{BUILD_DIR}/bmb_bin']
-    cargo_exit_code = subprocess.run(cargo, env=cargo_env).returncode
+def _newest_input() -> int:
+    paths = list(WATCH_INPUTS)
+    for entry in os.scandir(ROOT_DIR):
+        if entry.is_dir() and os.path.exists(f'{entry.path}/Cargo.toml'):
+            paths.append(f'{entry.path}/Cargo.toml')
+            for dir_path, _, file_names in os.walk(f'{entry.path}/src'):
+                # Hidden names cover editor scratch files like vim's .*.swp and emacs' .#* locks
+                paths.extend(f'{dir_path}/{name}' for name in file_names
+                    if name.endswith(WATCH_SRC_EXTENSIONS) and not name.startswith(('.', '#')))
+    newest = 0
+    for path in paths:
+        # Editors create and delete temporary files at any time
+        try:
+            newest = max(newest, os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return newest
+
+
+def _watch_build(argv, env) -> int:
+    """Waits on a long-lived `cargo watch` running `argv`, starting it if there isn't one"""
+    os.makedirs(WATCH_DIR, exist_ok=True)
+    # The UEFI argv has no path in it, so the checkout has to be part of the key
+    key = hashlib.sha1(shlex.join((ROOT_DIR, *argv)).encode()).hexdigest()[:12]
+    pid_file, log_file = f'{WATCH_DIR}/cargo-{key}.pid', f'{WATCH_DIR}/cargo-{key}.log'
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read())
+    except (FileNotFoundError, ValueError):
+        pid = None
+    spawned = pid is None or not _is_watcher(pid)
+    if spawned:
+        # Every run is bracketed with its start time and exit code so this can tell which
+        # sources the last finished build actually saw
+        run = f'echo "[bmb started $(date +%s%N)]"; {shlex.join(argv)}; echo "[bmb finished $?]"'
+        watch = ('cargo', 'watch', '-s', run)
+        log_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        # Started from the workspace root so _is_watcher can tell which checkout it belongs to
+        cwd = os.getcwd()
+        os.chdir(ROOT_DIR)
+        try:
+            pid = os.posix_spawnp(watch[0], watch, env, setsid=True, file_actions=[
+                (os.POSIX_SPAWN_OPEN, 1, log_file, log_flags, 0o644),
+                (os.POSIX_SPAWN_DUP2, 1, 2),
+            ])
+        finally:
+            os.chdir(cwd)
+        with open(pid_file, 'w') as f:
+            f.write(str(pid))
+        print(f'Started cargo watch ({pid}), output goes to {log_file}')
+    # Only a build that started after the newest input changed has seen it
+    newest = _newest_input()
+    deadline = time.monotonic() + WATCH_TIMEOUT
+    # A watcher spawned here may not have exec'd yet, but as a child it can be polled directly
+    while (os.waitpid(pid, os.WNOHANG)[0] == 0) if spawned else _is_watcher(pid):
+        started = exit_code = None
+        try:
+            with open(log_file, 'rb') as f:
+                lines = f.read().decode(errors='replace').splitlines()
+        except FileNotFoundError:
+            lines = []
+        for line in reversed(lines):
+            if exit_code is None and (match := WATCH_FINISHED.match(line)):
+                exit_code = int(match.group(1))
+            elif match := WATCH_STARTED.match(line):
+                started = int(match.group(1))
+                break
+        if started is not None and exit_code is not None and started >= newest:
+            return exit_code
+        if time.monotonic() > deadline:
+            print(f'Timed out waiting for cargo watch, see {log_file}')
+            return 1
+        time.sleep(0.2)
+    print(f'cargo watch exited, see {log_file}')
+    return 1
+
+
+def _prefetch(paths) -> None:
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def _is_up_to_date(src, *outputs) -> bool:
+    try:
+        src_mtime = os.stat(src).st_mtime_ns
+        return all(src_mtime <= os.stat(output).st_mtime_ns for output in outputs)
+    except FileNotFoundError:
+        return False
+
+
+def _ensure_ovmf() -> None:
+    os.makedirs(OVMF_DIR, exist_ok=True)
+    for dst in (OVMF_CODE, OVMF_VARS):
+        name = os.path.basename(dst)
+        src = f'{ROOT_DIR}/{name}' if os.path.exists(f'{ROOT_DIR}/{name}') else f'{OVMF_ROOT}/{name}'
+        if not os.path.exists(src):
+            sys.exit(f"Couldn't find {name} in {ROOT_DIR} or {OVMF_ROOT}, see the README's requirements")
+        if dst == OVMF_CODE:
+            if os.path.islink(dst) and os.readlink(dst) == src:
+                continue
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.symlink(src, dst)
+        else:
+            # qemu writes EFI variables back into this one, so it needs a private copy. Its
+            # contents drift from the source as a matter of course, only a source that's newer
+            # than the copy (e.g. a freshly dropped in one) replaces it
+            if os.path.exists(dst) and os.stat(src).st_mtime_ns <= os.stat(dst).st_mtime_ns:
+                continue
+            shutil.copyfile(src, dst)
+
+
+def build_with_bios(base_cargo_args, release=False, watch=False) -> int:
+    BUILD_DIR = BIOS_BUILD_DIRS[release]
+    cargo = (*base_cargo_args, '--features', 'bios')
+    objcopy_passes = (
+        (('--only-keep-debug',), f'{BUILD_DIR}/bmb_sym'),
+        (('-O', 'binary'), f'{BUILD_DIR}/bmb_bin'),
+    )
+    if watch:
+        # cargo watch doesn't report freshness, so only the mtimes can tell
+        cargo_exit_code, fresh = _watch_build(cargo, BIOS_CARGO_ENV), True
+    else:
+        cargo_exit_code, fresh = _cargo_build(cargo, BIOS_CARGO_ENV, 'bootloader')
     if cargo_exit_code != 0:
         return cargo_exit_code
-    objcopy_exit_code = subprocess.run(objcopy_strip_debug).returncode
-    if objcopy_exit_code != 0:
-        return objcopy_exit_code
-    return subprocess.run(objcopy_output_binary).returncode
+    # A fresh ELF only means cargo didn't relink it, the last objcopy may still have failed
+    if fresh and _is_up_to_date(f'{BUILD_DIR}/bootloader', *(output for _, output in objcopy_passes)):
+        return 0
+    # Both passes only read the ELF and write separate outputs, so they can run side by side
+    pids = [_start(('objcopy', *flags, f'{BUILD_DIR}/bootloader', output)) for flags, output in objcopy_passes]
+    exit_codes = [_wait(pid) for pid in pids]
+    return next((code for code in exit_codes if code != 0), 0)
                 
 
-def run_with_bios(base_qemu_args, release=False) -> None:
-    sub_dir = 'release' if release else 'debug'
-    BUILD_DIR = f'{root_dir}/target/x86_64-bios-target/{sub_dir}'
-    qemu  = base_qemu_args + ['-drive', f'file={BUILD_DIR}/bmb_bin,format=raw']
-    subprocess.run(qemu)
+def run_with_bios(base_qemu_args, release=False) -> tuple:
+    BUILD_DIR = BIOS_BUILD_DIRS[release]
+    return (*base_qemu_args, '-drive', f'file={BUILD_DIR}/bmb_bin,format=raw')
 
 
-def build_with_uefi(base_cargo_args) -> int:
-    return subprocess.run(base_cargo_args).returncode
+def build_with_uefi(base_cargo_args, watch=False) -> int:
+    if watch:
+        return _watch_build(base_cargo_args, CARGO_ENV)
+    return _spawn(base_cargo_args, CARGO_ENV)
 
-def run_with_uefi(base_qemu_args, release=False) -> None:
-    sub_dir = 'release' if release else 'debug'
-    BUILD_DIR = f'{root_dir}/target/x86_64-unknown-uefi/{sub_dir}'
-    OVMF_ROOT = '/usr/share/edk2/ovmf'
-    subprocess.run([
+def run_with_uefi(base_qemu_args, release=False) -> tuple:
+    BUILD_DIR = UEFI_BUILD_DIRS[release]
+    return (
         *base_qemu_args,
         '-s',
-        '-accel','kvm',
-        '-drive', f'if=pflash,format=raw,unit=0,file=OVMF_CODE.fd,readonly=on',
-        '-drive', f'if=pflash,unit=1,format=raw,file=OVMF_VARS.fd',
+        '-drive', f'if=pflash,format=raw,unit=0,file={OVMF_CODE},readonly=on',
+        '-drive', f'if=pflash,unit=1,format=raw,file={OVMF_VARS}',
         '-drive', f'format=raw,file=fat:rw:{BUILD_DIR}',
-        '-cpu', 'qemu64'
-    ])
+    )
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    target = f'{root_dir}/x86_64-bios-target.json' if args.bios else 'x86_64-unknown-uefi'
-    base_cargo_args = [
+    if not args.build_only:
+        if not args.bios:
+            _ensure_ovmf()
+        # Let the kernel read qemu and the firmware in while cargo is busy
+        prefetch = [shutil.which('qemu-system-x86_64')] + ([] if args.bios else [OVMF_CODE, OVMF_VARS])
+        threading.Thread(target=_prefetch, args=([path for path in prefetch if path],), daemon=True).start()
+    target = BIOS_TARGET if args.bios else UEFI_TARGET
+    base_cargo_args = (
         'cargo', 'b', '-p', 'bootloader', '--target', target,
         '-Zbuild-std=core,compiler_builtins', '-Zbuild-std-features=compiler-builtins-mem',
-    ]
-    base_qemu_args = ['qemu-system-x86_64', 
-        '-device', 'ich9-intel-hda,debug=4', '-device', 'hda-micro', '-device', 'hda-micro']
-    if args.release:
-        base_cargo_args += ['--release']
-    if args.debug:
-        base_qemu_args += ['-S', '-s']
+        *(('--release',) if args.release else ()),
+    )
     if args.bios:
-        if build_with_bios(base_cargo_args, args.release) == 0:
-            if not args.build_only:
-                run_with_bios(base_qemu_args, args.release)
+        exit_code = build_with_bios(base_cargo_args, args.release, args.watch)
+        run_with = run_with_bios
     else:
-        if build_with_uefi(base_cargo_args) == 0:
-            if not args.build_only:
-                run_with_uefi(base_qemu_args, args.release)
+        exit_code = build_with_uefi(base_cargo_args, args.watch)
+        run_with = run_with_uefi
+    if exit_code != 0 or args.build_only:
+        sys.exit(exit_code)
+    KVM = os.access('/dev/kvm', os.R_OK | os.W_OK)
+    base_qemu_args = ('qemu-system-x86_64',
+        '-device', 'ich9-intel-hda,debug=4', '-device', 'hda-micro', '-device', 'hda-micro',
+        *(('-accel', 'kvm', '-cpu', 'host') if KVM else ('-accel', 'tcg', '-cpu', 'qemu64')),
+        *(('-S', '-s') if args.debug else ()),
+    )
+    # Nothing is left to do after qemu, so let it take over this process
+    qemu = run_with(base_qemu_args, args.release)
+    # exec doesn't flush Python's buffers, anything still sitting in them would be lost
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(qemu[0], qemu)
     
 